@@ -3,6 +3,7 @@ import json
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cv2
@@ -13,7 +14,7 @@ from tqdm import tqdm
 
 from utils import user_interface
 from utils.annotation import create_annotation, update_annotation
-from utils.contour_analysis import aggregate_measurements
+from utils.contour_analysis import aggregate_measurements, flush_database
 from utils.data import list_files
 from utils.model import load_model
 from utils.utils import (DEFAULT_MODEL_INPUT_SHAPE, MODEL_PATH,
@@ -152,6 +153,9 @@ def main():
     height, width, channels = DEFAULT_MODEL_INPUT_SHAPE
     image_tensor = np.empty((1, height, width, channels))
 
+    # Contour analysis and annotation of an image run in the background while the next image is predicted.
+    postprocessing = ThreadPoolExecutor(max_workers=1)
+
     # UI loop
     while True:
         event = None
@@ -285,6 +289,7 @@ def main():
 
                         # Load and process each image and annotation
                         logging.debug("Start processing images and annotations")
+                        pending_postprocessing = None
                         for i, (image_path, annotation_path) in enumerate(zip(images, annotations)):
                             logging.debug(f"Processing image {image_path} and annotation {annotation_path}")
                             if patient == "":
@@ -333,7 +338,11 @@ def main():
 
                             hashfile = get_hash_file(image_path)
 
-                            update_annotation(
+                            # Wait for the previous image, so at most one image is waiting to be post-processed.
+                            if pending_postprocessing is not None:
+                                pending_postprocessing.result()
+                            pending_postprocessing = postprocessing.submit(
+                                update_annotation,
                                 input_image=image_original,
                                 prediction=prediction,
                                 patient_record=patient_record,
@@ -356,6 +365,9 @@ def main():
                             tf.keras.backend.clear_session()
                             logging.debug(f"Done processing image {image_path}")
 
+                        if pending_postprocessing is not None:
+                            pending_postprocessing.result()
+
                         logging.debug(f"Aggregating measurements")
                         aggregation_result = aggregate_measurements(
                             nucleus_measurements=str(Path(output_directory).joinpath(f"nucleus_measurements_{datetime}.csv")),
@@ -425,6 +437,7 @@ def main():
 
                             # Load and process each image
                             logging.debug("Start processing images")
+                            pending_postprocessing = None
                             for i, image_path in enumerate(images):
                                 logging.debug(f"Processing image {image_path}")
                                 if patient == "":
@@ -473,7 +486,11 @@ def main():
 
                                 hashfile = get_hash_file(image_path)
 
-                                create_annotation(
+                                # Wait for the previous image, so at most one image is waiting to be post-processed.
+                                if pending_postprocessing is not None:
+                                    pending_postprocessing.result()
+                                pending_postprocessing = postprocessing.submit(
+                                    create_annotation,
                                     input_image=image_original,
                                     prediction=prediction,
                                     patient_record=patient_record,
@@ -495,6 +512,9 @@ def main():
                                 tf.keras.backend.clear_session()
                                 logging.debug(f"Done processing image {image_path}")
 
+                            if pending_postprocessing is not None:
+                                pending_postprocessing.result()
+
                             logging.debug(f"Aggregating measurements")
                             aggregation_result = aggregate_measurements(
                                 nucleus_measurements=str(output_directory.joinpath(f"nucleus_measurements_{datetime}.csv")),
@@ -523,6 +543,8 @@ def main():
 
                 logging.debug(f"Done processing directory '{input_directory}'")
 
+            flush_database()
+
             if open_labelme and multiple_patients:
                 open_with_labelme(str(base_directory))
         else:
@@ -539,6 +561,8 @@ def main():
         
         logging.debug("Selected directory event end")
 
+    postprocessing.shutdown()
+
     if not console_mode:
         window.close()
 
@@ -2,14 +2,14 @@ import json
 import logging
 import shutil
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 import cv2
 import numpy as np
 
 from utils import contour_analysis
 from utils.utils import (DECISION_TREE_MODEL_PATH, MSKG_VERSION, color_classes, convert_bbox_to_contour,
-                         get_labelme_shapes)
+                         get_labelme_shapes, label_to_onehot)
 
 
 def get_segmentation_overlay(
@@ -34,6 +34,24 @@ def get_segmentation_overlay(
     return overlay
 
 
+def classify_nuclei_agnors(prediction: np.ndarray, nuclei: List[tuple]) -> None:
+    """Classifies the AgNORs of all nuclei of an image at once and draws the satellites in the fourth channel of `prediction`.
+
+    Args:
+        prediction (np.ndarray): The segmented image, with an extra channel to map satellites.
+        nuclei (List[tuple]): The nuclei of the image, each as a tuple with the nucleus contour, its AgNOR contours, and its nucleus and AgNOR measurements. The `type` of the AgNOR measurements is updated in place.
+    """
+    contours = [contour for _, child_contours, _, _ in nuclei for contour in child_contours]
+    measurements = [measurement for _, _, _, child_measurements in nuclei for measurement in child_measurements]
+    contour_analysis.classify_agnor(DECISION_TREE_MODEL_PATH, measurements)
+
+    # OpenCV's `drawContours` fails using array slices, so a new matrix must be created, drawn on and assigned to `predictions`.
+    satellites = prediction[:, :, 3].copy()
+    satellite_contours = [contour for measurement, contour in zip(measurements, contours) if measurement["type"] == "satellite"]
+    cv2.drawContours(satellites, contours=satellite_contours, contourIdx=-1, color=1, thickness=cv2.FILLED)
+    prediction[:, :, 3] = satellites
+
+
 def create_annotation(
     input_image: np.ndarray,
     prediction: np.ndarray,
@@ -104,14 +122,12 @@ def create_annotation(
 
     if classify_agnor:
         logging.debug("Add an extra channel to map 'satellites'")
-        prediction = np.stack([
-            prediction[:, :, 0],
-            prediction[:, :, 1],
-            prediction[:, :, 2],
-            np.zeros(original_image_shape, dtype=np.uint8)
-        ], axis=2)
+        prediction = label_to_onehot(prediction, classes=4)
+    else:
+        prediction = label_to_onehot(prediction)
 
-    logging.debug("Obtain contour measurements and append shapes to annotation file")
+    logging.debug("Obtain contour measurements")
+    nuclei = []
     for i, parent_contour in enumerate(parent_contours):
         filtered_child_contour, _ = contour_analysis.discard_contours_outside_contours([parent_contour], child_contours)
         parent_measurements, child_measurements = contour_analysis.get_contour_measurements(
@@ -126,20 +142,16 @@ def create_annotation(
             exam_instance=exam_instance,
             anatomical_site=anatomical_site,
             start_index=i)
+        nuclei.append((parent_contour, filtered_child_contour, parent_measurements, child_measurements))
 
-        if classify_agnor:
-            child_measurements = contour_analysis.classify_agnor(DECISION_TREE_MODEL_PATH, child_measurements)
-            # OpenCV's `drawContours` fails using array slices, so a new matrix must be created, drawn on and assigned to `predictions`.
-            satellites = prediction[:, :, 3].copy()
-            for classified_measurement, classified_contour in zip(child_measurements, filtered_child_contour):
-                if classified_measurement["type"] == "satellite":
-                    cv2.drawContours(satellites, contours=[classified_contour], contourIdx=-1, color=1, thickness=cv2.FILLED)
-            prediction[:, :, 3] = satellites
+    if classify_agnor:
+        logging.debug("Classify AgNORs")
+        classify_nuclei_agnors(prediction, nuclei)
 
+    logging.debug("Append shapes to annotation file")
+    for parent_contour, filtered_child_contour, parent_measurements, child_measurements in nuclei:
         # Prepare and append nucleus shape
-        points = []
-        for point in parent_contour:
-            points.append([int(value) for value in point[0]])
+        points = parent_contour.reshape(-1, 2).tolist()
 
         shape = {
             "label": "nucleus",
@@ -151,9 +163,7 @@ def create_annotation(
         annotation["shapes"].append(shape)
 
         for measurement, contour in zip(child_measurements, filtered_child_contour):
-            points = []
-            for point in contour:
-                points.append([int(value) for value in point[0]])
+            points = contour.reshape(-1, 2).tolist()
 
             shape = {
                 "label": measurement["type"],
@@ -269,6 +279,7 @@ def update_annotation(
     logging.debug("Analyze contours")
     prediction, _ = contour_analysis.analyze_contours(mask=prediction, smooth=True)
     prediction, parent_contours, child_contours = prediction
+    prediction = label_to_onehot(prediction)
 
     logging.debug("Remove contours outside bounding boxes")
     prediction = contour_analysis.discard_unboxed_contours(prediction, parent_contours, child_contours, annotation=annotation_path)
@@ -280,22 +291,24 @@ def update_annotation(
 
     if classify_agnor:
         logging.debug("Add an extra channel to map 'satellites'")
-        prediction = np.stack([
+        prediction = cv2.merge([
             prediction[:, :, 0],
             prediction[:, :, 1],
             prediction[:, :, 2],
             np.zeros(original_image_shape, dtype=np.uint8)
-        ], axis=2)
+        ])
 
-    logging.debug("Obtain contour measurements and append shapes to annotation file")
+    logging.debug("Obtain contour measurements")
     bounding_boxes_shapes = get_labelme_shapes(annotation_path=annotation_path, shape_types=["rectangle"])
     # Variable to enumerate nucleus during processing
     i = 0
     # Prevent duplicate annotations by keeping a list of unseen objects
     unseen_contours = parent_contours
+    # Nuclei of each bounding box, kept so the shapes are appended after AgNORs are classified
+    boxed_nuclei = []
     for rectangle in bounding_boxes_shapes:
         rectangle["label"] = f"BoundingBox {i+1}"
-        annotation["shapes"].append(rectangle)
+        boxed_nuclei.append((rectangle, []))
 
         # Convert rectangle points so it can be used in OpenCV to filter other contours
         rectangle = convert_bbox_to_contour(rectangle["points"].copy())
@@ -316,20 +329,19 @@ def update_annotation(
                 exam_instance=exam_instance,
                 anatomical_site=anatomical_site,
                 start_index=i)
+            boxed_nuclei[-1][1].append((parent_contour, filtered_child_contour, parent_measurements, child_measurements))
+            i += 1
 
-            if classify_agnor:
-                child_measurements = contour_analysis.classify_agnor(DECISION_TREE_MODEL_PATH, child_measurements)
-                # OpenCV's `drawContours` fails using array slices, so a new matrix must be created, drawn on and assigned to `predictions`.
-                satellites = prediction[:, :, 3].copy()
-                for classified_measurement, classified_contour in zip(child_measurements, filtered_child_contour):
-                    if classified_measurement["type"] == "satellite":
-                        cv2.drawContours(satellites, contours=[classified_contour], contourIdx=-1, color=1, thickness=cv2.FILLED)
-                prediction[:, :, 3] = satellites
+    if classify_agnor:
+        logging.debug("Classify AgNORs")
+        classify_nuclei_agnors(prediction, [nucleus for _, nuclei in boxed_nuclei for nucleus in nuclei])
 
+    logging.debug("Append shapes to annotation file")
+    for rectangle, nuclei in boxed_nuclei:
+        annotation["shapes"].append(rectangle)
+        for parent_contour, filtered_child_contour, parent_measurements, child_measurements in nuclei:
             # Prepare and append nucleus shape
-            points = []
-            for point in parent_contour:
-                points.append([int(value) for value in point[0]])
+            points = parent_contour.reshape(-1, 2).tolist()
 
             shape = {
                 "label": "nucleus",
@@ -341,9 +353,7 @@ def update_annotation(
             annotation["shapes"].append(shape)
 
             for measurement, contour in zip(child_measurements, filtered_child_contour):
-                points = []
-                for point in contour:
-                    points.append([int(value) for value in point[0]])
+                points = contour.reshape(-1, 2).tolist()
 
                 shape = {
                     "label": measurement["type"],
@@ -359,7 +369,6 @@ def update_annotation(
                 child_measurements=child_measurements,
                 output_path=output_directory,
                 datetime=datetime)
-            i += 1
 
     logging.debug("Write annotation file")
     annotation["last_updated"] = datetime
@@ -1,9 +1,11 @@
+import atexit
 import csv
+import functools
 import logging
 import os
 import time
 from pathlib import Path
-from typing import List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import cv2
 import joblib
@@ -12,8 +14,8 @@ import pandas as pd
 import tensorflow as tf
 from scipy.interpolate import splev, splprep
 
-from utils.utils import (color_classes, convert_bbox_to_contour,
-                         get_labelme_points)
+from utils.utils import (color_classes, convert_bboxes_to_contours,
+                         get_labelme_points, label_to_onehot)
 
 
 NUCLEUS_COLUMNS = [
@@ -46,6 +48,29 @@ AGNOR_COLUMNS = [
     "greatest_agnor_ratio",
     "smallest_agnor_ratio"]
 
+# Columns read back from the measurement files by `aggregate_measurements`.
+NUCLEUS_USE_COLS = ["nucleus_pixel_count"]
+
+AGNOR_USE_COLS = [
+    "patient_record",
+    "patient_name",
+    "source_image",
+    "group",
+    "exam_date",
+    "exam_instance",
+    "anatomical_site",
+    "nucleus",
+    "agnor",
+    "agnor_pixel_count",
+    "type"]
+
+# Features used by the AgNOR classifier, in the order it was trained with.
+AGNOR_FEATURES = [
+    "agnor_pixel_count",
+    "nucleus_ratio",
+    "smallest_agnor_ratio",
+    "greatest_agnor_ratio"]
+
 CLASSES = [
     "control",
     "leukoplakia",
@@ -74,6 +99,15 @@ MAX_CONTOUR_PERCENT_DIFF = 5.0
 # - avg: 92.36167625840966
 # - std: 171.46624198587395
 
+# OpenCV releases the GIL while rasterizing, so per-contour work scales with threads.
+THREAD_POOL = joblib.Parallel(n_jobs=-1, prefer="threads")
+
+# Measurements waiting to be written, keyed by output file. Written by `flush_contour_measurements`.
+_MEASUREMENT_BUFFERS: Dict[Path, List[pd.DataFrame]] = {}
+
+# Aggregate measurements waiting to be written, keyed by database file. Written by `flush_database`.
+_DATABASE_BUFFERS: Dict[str, List[pd.DataFrame]] = {}
+
 
 def smooth_contours(contours: List[np.ndarray], points: Optional[int] = 30) -> List[np.ndarray]:
     """Smooth a list of contours using a B-spline approximation.
@@ -105,9 +139,12 @@ def smooth_contours(contours: List[np.ndarray], points: Optional[int] = 30) -> L
             # https://docs.scipy.org/doc/scipy-0.14.0/reference/generated/scipy.interpolate.splev.html
             x_new, y_new = splev(u_new, tck, der=0)
 
-            # Convert it back to Numpy format for OpenCV to be able to display it
-            res_array = [[[int(i[0]), int(i[1])]] for i in zip(x_new,y_new)]
-            smoothened_contours.append(np.asarray(res_array, dtype=np.int32))
+            # Convert it back to Numpy format for OpenCV to be able to display it.
+            # Casting truncates towards zero like `int()`, which would also fail on non-finite values.
+            smoothed_points = np.stack([x_new, y_new], axis=1)
+            if not np.isfinite(smoothed_points).all():
+                raise ValueError("the smoothed contour has non-finite points")
+            smoothened_contours.append(smoothed_points.astype(np.int32).reshape(-1, 1, 2))
         except Exception as e:
             print(f"The smoothing of a contour caused a failure: {e}")
     return smoothened_contours
@@ -122,16 +159,19 @@ def get_contours(mask: np.ndarray) -> List[np.ndarray]:
     Returns:
         List[np.ndarray]: The list of contours found in the mask.
     """
-    mask = mask.copy()
-    mask[mask > 0] = 255
-    mask = mask.astype(np.uint8)
+    # `cv2.findContours` treats any non-zero pixel as foreground and does not modify its input, so `uint8` masks are used as they are.
+    if mask.dtype != np.uint8:
+        mask = (mask > 0).astype(np.uint8)
     contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     return contours
 
 
-def get_contour_pixel_count(contour: np.ndarray, shape: List[np.ndarray]) -> int:
+def get_contour_pixel_count(contour: np.ndarray, shape: Tuple[int, int]) -> int:
     """Counts the number of pixels in a given contour.
 
+    The contour is rasterized only within its bounding rectangle (clipped to `shape`), so the cost depends on the size of the contour instead of the size of the image.
+    The count is the same as filling the contour in an image of dimensions `shape`.
+
     Args:
         contour (np.ndarray): The contour to be evaluated.
         shape (Tuple[int, int]): The dimensions of the image from where the contours were extrated, in the format `(HEIGHT, WIDTH)`.
@@ -139,11 +179,201 @@ def get_contour_pixel_count(contour: np.ndarray, shape: List[np.ndarray]) -> int
     Returns:
         int: The number of pixels in the contour.
     """
-    image = np.zeros(shape, dtype=np.uint8)
-    cv2.drawContours(image, contours=[contour], contourIdx=-1, color=1, thickness=cv2.FILLED)
+    x, y, width, height = cv2.boundingRect(contour)
+    x_min, y_min = max(x, 0), max(y, 0)
+    x_max, y_max = min(x + width, shape[1]), min(y + height, shape[0])
+    if x_max <= x_min or y_max <= y_min:
+        return 0
+
+    image = np.zeros((y_max - y_min, x_max - x_min), dtype=np.uint8)
+    cv2.drawContours(image, contours=[contour], contourIdx=-1, color=1, thickness=cv2.FILLED, offset=(-x_min, -y_min))
     return int(image.sum())
 
 
+def get_contours_pixel_count(contours: List[np.ndarray], shape: Tuple[int, int]) -> np.ndarray:
+    """Counts the number of pixels of each contour in a list of non-overlapping contours.
+
+    All contours are filled at once into a single image, and `cv2.connectedComponentsWithStats` measures every filled region in one pass.
+    Each contour is then matched to the region containing its first point.
+    Overlapping or touching contours would be merged into the same region, so this is meant for contours that are never connected, such as the external contours found by `get_contours`.
+
+    Args:
+        contours (List[np.ndarray]): The contours to be evaluated.
+        shape (Tuple[int, int]): The dimensions of the image from where the contours were extrated, in the format `(HEIGHT, WIDTH)`.
+
+    Returns:
+        np.ndarray: The number of pixels of each contour, in the same order as `contours`.
+    """
+    if len(contours) == 0:
+        return np.zeros((0,), dtype=np.int32)
+
+    filled = np.zeros(shape, dtype=np.uint8)
+    cv2.drawContours(filled, contours=contours, contourIdx=-1, color=1, thickness=cv2.FILLED)
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(filled, connectivity=8, ltype=cv2.CV_32S)
+
+    first_points = np.array([contour.reshape(-1, 2)[0] for contour in contours])
+    return stats[labels[first_points[:, 1], first_points[:, 0]], cv2.CC_STAT_AREA]
+
+
+class ContourInfo:
+    """A contour and the geometry derived from it, computed on first access and cached for later stages.
+
+    Args:
+        points (np.ndarray): The contour.
+        shape (Tuple[int, int]): The dimensions of the image from where the contour was extracted, in the format `(HEIGHT, WIDTH)`.
+    """
+    __slots__ = ("points", "shape", "_pixel_count", "_convex_hull", "_convex_hull_pixel_count")
+
+    def __init__(self, points: np.ndarray, shape: Tuple[int, int]):
+        self.points = points
+        self.shape = shape
+        self._pixel_count = None
+        self._convex_hull = None
+        self._convex_hull_pixel_count = None
+
+    @property
+    def pixel_count(self) -> int:
+        """int: The number of pixels in the contour."""
+        if self._pixel_count is None:
+            self._pixel_count = get_contour_pixel_count(self.points, self.shape)
+        return self._pixel_count
+
+    @property
+    def convex_hull(self) -> np.ndarray:
+        """np.ndarray: The convex hull of the contour."""
+        if self._convex_hull is None:
+            self._convex_hull = cv2.convexHull(self.points)
+        return self._convex_hull
+
+    @property
+    def convex_hull_pixel_count(self) -> int:
+        """int: The number of pixels in the convex hull of the contour."""
+        if self._convex_hull_pixel_count is None:
+            self._convex_hull_pixel_count = get_contour_pixel_count(self.convex_hull, self.shape)
+        return self._convex_hull_pixel_count
+
+
+def get_contours_points(contours: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Gathers the points of a list of contours into a single array.
+
+    Args:
+        contours (List[np.ndarray]): The contours to gather the points from.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The points of all contours in the format `(N, 2)`, and the index of the contour each point belongs to.
+    """
+    if len(contours) == 0:
+        return np.empty((0, 2), dtype=np.int32), np.empty((0,), dtype=np.int64)
+
+    points = [contour.reshape(-1, 2) for contour in contours]
+    owners = np.repeat(np.arange(len(points)), [len(contour_points) for contour_points in points])
+    return np.vstack(points), owners
+
+
+def get_points_in_contour(contour: np.ndarray, points: np.ndarray) -> np.ndarray:
+    """Checks which points are inside or on the edge of a contour.
+
+    Gives the same result as `cv2.pointPolygonTest(contour, point, False) >= 0` for every point, but tests all points at once.
+    The test uses integer arithmetic and the even-odd rule, so points lying exactly on the edge of the contour are considered inside.
+
+    Args:
+        contour (np.ndarray): The contour to test the points against.
+        points (np.ndarray): The points to be tested, in the format `(N, 2)`.
+
+    Returns:
+        np.ndarray: A boolean array of length `N` that is `True` for the points inside or on the edge of the contour.
+    """
+    vertices = contour.reshape(-1, 2).astype(np.int64)
+    x0, y0 = vertices[:, 0:1], vertices[:, 1:2]
+    x1, y1 = np.roll(x0, -1, axis=0), np.roll(y0, -1, axis=0)
+    px, py = points[:, 0].astype(np.int64), points[:, 1].astype(np.int64)
+
+    # Positive if the point is on the left of the edge, negative if it is on the right, and zero if it is collinear.
+    side = (x1 - x0) * (py - y0) - (y1 - y0) * (px - x0)
+
+    on_edge = (side == 0) \
+        & (np.minimum(x0, x1) <= px) & (px <= np.maximum(x0, x1)) \
+        & (np.minimum(y0, y1) <= py) & (py <= np.maximum(y0, y1))
+    # Edges crossed by a horizontal ray cast from the point towards the right.
+    crossings = ((y0 <= py) & (py < y1) & (side > 0)) | ((y1 <= py) & (py < y0) & (side < 0))
+
+    return on_edge.any(axis=0) | (np.count_nonzero(crossings, axis=0) % 2 == 1)
+
+
+def get_children_in_contour(
+    parent_contour: np.ndarray,
+    child_points: np.ndarray,
+    child_owners: np.ndarray,
+    child_first_points: np.ndarray,
+    candidate_children: np.ndarray) -> np.ndarray:
+    """Finds the candidate child contours that have at least one point inside or on the edge of a parent contour.
+
+    The first point of each candidate is tested before the others, and children accepted by it do not get their remaining points tested.
+    Children lying inside the parent are usually accepted by their first point, so most of the points are never tested.
+
+    Args:
+        parent_contour (np.ndarray): The parent contour.
+        child_points (np.ndarray): The points of all child contours, in the format `(N, 2)`, as returned by `get_contours_points`.
+        child_owners (np.ndarray): The index of the child contour each point belongs to.
+        child_first_points (np.ndarray): The index of the first point of each child contour in `child_points`.
+        candidate_children (np.ndarray): A boolean array that is `True` for the child contours to be tested.
+
+    Returns:
+        np.ndarray: The indices of the child contours with a point inside the parent contour.
+    """
+    candidates = np.flatnonzero(candidate_children)
+    first_point_inside = get_points_in_contour(parent_contour, child_points[child_first_points[candidates]])
+
+    remaining_children = np.zeros_like(candidate_children)
+    remaining_children[candidates[~first_point_inside]] = True
+    remaining_points = np.flatnonzero(remaining_children[child_owners])
+    remaining_points_inside = get_points_in_contour(parent_contour, child_points[remaining_points])
+
+    return np.concatenate([candidates[first_point_inside], child_owners[remaining_points[remaining_points_inside]]])
+
+
+def get_contours_containment(parent_contours: List[np.ndarray], child_contours: List[np.ndarray]) -> np.ndarray:
+    """Checks which child contours have at least one point inside or on the edge of each parent contour.
+
+    The points of all child contours are gathered once, and only the children whose bounding rectangle intersects the bounding rectangle of a parent get tested against it with `get_children_in_contour`.
+    NumPy releases the GIL while evaluating the tests, so multiple parents are tested in parallel on `THREAD_POOL`.
+
+    Args:
+        parent_contours (List[np.ndarray]): The list of contours to be considered as the parent contours.
+        child_contours (List[np.ndarray]): The list of contours to be considered as child contours of the parent contours.
+
+    Returns:
+        np.ndarray: A boolean matrix in the format `(PARENTS, CHILDREN)` that is `True` where the child contour has a point inside the parent contour.
+    """
+    containment = np.zeros((len(parent_contours), len(child_contours)), dtype=bool)
+    child_points, child_owners = get_contours_points(child_contours)
+    child_first_points = np.searchsorted(child_owners, np.arange(len(child_contours)))
+
+    child_rects = np.array([cv2.boundingRect(child) for child in child_contours], dtype=np.int64).reshape(-1, 4)
+    child_x_min, child_y_min = child_rects[:, 0], child_rects[:, 1]
+    child_x_max, child_y_max = child_x_min + child_rects[:, 2], child_y_min + child_rects[:, 3]
+
+    candidate_children = []
+    for parent in parent_contours:
+        x, y, width, height = cv2.boundingRect(parent)
+        # Children whose bounding rectangle does not intersect the parent's cannot have points inside it.
+        candidate_children.append((child_x_min < x + width) & (x < child_x_max) & (child_y_min < y + height) & (y < child_y_max))
+
+    # Dispatching a single parent to the thread pool costs more than testing it.
+    if len(parent_contours) > 1:
+        children_in_parents = THREAD_POOL(
+            joblib.delayed(get_children_in_contour)(parent, child_points, child_owners, child_first_points, candidates)
+            for parent, candidates in zip(parent_contours, candidate_children))
+    else:
+        children_in_parents = [
+            get_children_in_contour(parent, child_points, child_owners, child_first_points, candidates)
+            for parent, candidates in zip(parent_contours, candidate_children)]
+
+    for parent_index, children_in_parent in enumerate(children_in_parents):
+        containment[parent_index, children_in_parent] = True
+    return containment
+
+
 def dilate_contours(
     contours: List,
     structuring_element: Optional[int] = cv2.MORPH_ELLIPSE,
@@ -183,6 +413,8 @@ def discard_contours_by_size(
     min_relative_pixel_count: Optional[float] = MIN_NUCLEUS_PERCENT_PIXEL_COUNT) -> Union[List[np.ndarray], List[np.ndarray]]:
     """Discards contours smaller or bigger than the given thresholds.
 
+    The contours are expected not to overlap, as their pixels are counted with `get_contours_pixel_count`.
+
     Args:
         contours (List[np.ndarray]): The contours to be evaluated.
         shape (Tuple[int, int]): The dimensions of the image from where the contours were extrated, in the format `(HEIGHT, WIDTH)`.
@@ -194,9 +426,9 @@ def discard_contours_by_size(
     """
     kept = []
     discarded = []
-    for contour in contours:
-        contour_pixel_count = get_contour_pixel_count(contour, shape=shape)
-        min_pixel_count = int((min_relative_pixel_count * max_pixel_count) / 100)
+    min_pixel_count = int((min_relative_pixel_count * max_pixel_count) / 100)
+    contours_pixel_count = get_contours_pixel_count(contours, shape=shape)
+    for contour, contour_pixel_count in zip(contours, contours_pixel_count):
         if min_pixel_count <= contour_pixel_count and contour_pixel_count <= max_pixel_count:
             kept.append(contour)
         else:
@@ -218,12 +450,8 @@ def discard_contours_without_contours(
     """
     kept = []
     discarded = []
-    for parent in parent_contours:
-        keep_parent = False
-        for child in child_contours:
-            for child_point in child:
-                if cv2.pointPolygonTest(parent, tuple(child_point[0]), False) >= 0:
-                    keep_parent = True
+    keep_parents = get_contours_containment(parent_contours, child_contours).any(axis=1)
+    for parent, keep_parent in zip(parent_contours, keep_parents):
         if keep_parent:
             kept.append(parent)
         else:
@@ -247,15 +475,8 @@ def discard_contours_outside_contours(
     """
     kept = []
     discarded = []
-    for child in child_contours:
-        keep_child = False
-        for parent in parent_contours:
-            for child_point in child:
-                if cv2.pointPolygonTest(parent, tuple(child_point[0]), False) >= 0:
-                    keep_child = True
-                    break
-            if keep_child:
-                break
+    keep_children = get_contours_containment(parent_contours, child_contours).any(axis=0)
+    for child, keep_child in zip(child_contours, keep_children):
         if keep_child:
             kept.append(child)
         else:
@@ -263,10 +484,44 @@ def discard_contours_outside_contours(
     return kept, discarded
 
 
+def discard_contours_outside_mask(
+    mask: np.ndarray,
+    contours: List[np.ndarray]) -> Union[List[np.ndarray], List[np.ndarray]]:
+    """Discards contours that do not have at least one point on a non-zero pixel of a mask.
+
+    Checking the points against a mask where the parent contours were rasterized once replaces the point-in-polygon tests of `discard_contours_outside_contours`.
+
+    Args:
+        mask (np.ndarray): The mask in the format `(HEIGHT, WIDTH)`, usually with the parent contours drawn on it.
+        contours (List[np.ndarray]): The list of contours to be checked. All points must be within the dimensions of `mask`.
+
+    Returns:
+        Union[List[np.ndarray], List[np.ndarray]]: The `kept` array contains the contours with a point on the mask. The `discarded` array contains the other contours.
+    """
+    points, owners = get_contours_points(contours)
+    keep = np.zeros(len(contours), dtype=bool)
+    keep[owners[mask[points[:, 1], points[:, 0]] > 0]] = True
+
+    kept = [contours[i] for i in np.flatnonzero(keep)]
+    discarded = [contours[i] for i in np.flatnonzero(~keep)]
+    return kept, discarded
+
+
+def get_contour_convex_pixel_count(contour: ContourInfo) -> Tuple[int, int]:
+    """Counts the number of pixels in a given contour and in its convex hull.
+
+    Args:
+        contour (ContourInfo): The contour to be evaluated. The counts and the convex hull get cached in it.
+
+    Returns:
+        Tuple[int, int]: The number of pixels in the contour and the number of pixels in its convex hull.
+    """
+    return contour.pixel_count, contour.convex_hull_pixel_count
+
+
 def discard_overlapping_deformed_contours(
-    contours: List[np.ndarray],
-    shape: Tuple[int, int],
-    max_diff: Optional[float] = MAX_CONTOUR_PERCENT_DIFF) -> Union[List[np.ndarray], List[np.ndarray]]:
+    contours: List[ContourInfo],
+    max_diff: Optional[float] = MAX_CONTOUR_PERCENT_DIFF) -> Union[List[ContourInfo], List[ContourInfo]]:
     """Discards contours overlapping with other and defformed contours.
 
     This function verifies if contours are overlapping with others by computing the difference in the number of pixels between the contour and the convex hull of that contour.
@@ -275,33 +530,36 @@ def discard_overlapping_deformed_contours(
     Deformed contours caused by obstruction or fragmented segmentation also get discarded under the same criterion.
 
     Args:
-        contours (List[np.ndarray]): The list of contours to be evaluated.
-        shape (Tuple[int, int]): The dimensions of the image from where the contours were extrated, in the format `(HEIGHT, WIDTH)`.
+        contours (List[ContourInfo]): The list of contours to be evaluated.
         max_diff (Optional[int], optional): The maximum percentage difference between the contour pixel count and its convex hull pixel count. If the difference is over `max_diff`, then the contour is discarded. Defaults to `MAX_CONTOUR_PERCENT_DIFF`.
 
     Returns:
-        Union[List[np.ndarray], List[np.ndarray]]: The `kept` array contains the contours that are not overlapping with other or are not deformed. The `discarded` array contains the overlapping and deforemed nuclei.
+        Union[List[ContourInfo], List[ContourInfo]]: The `kept` array contains the contours that are not overlapping with other or are not deformed. The `discarded` array contains the overlapping and deforemed nuclei.
     """
-    kept = []
-    discarded = []
-    for contour in contours:
-        contour_pixel_count = get_contour_pixel_count(contour, shape)
-        contour_convex_pixel_count = get_contour_pixel_count(cv2.convexHull(contour), shape)
-        diff = ((contour_convex_pixel_count - contour_pixel_count) / ((contour_convex_pixel_count + contour_pixel_count) / 2)) * 100
-        if diff <= max_diff:
-            kept.append(contour)
-        else:
-            discarded.append(contour)
+    pixel_counts = THREAD_POOL(joblib.delayed(get_contour_convex_pixel_count)(contour) for contour in contours)
+    pixel_counts = np.array(pixel_counts, dtype=np.float64).reshape(-1, 2)
+    contour_pixel_count, contour_convex_pixel_count = pixel_counts[:, 0], pixel_counts[:, 1]
+
+    diff = ((contour_convex_pixel_count - contour_pixel_count) / ((contour_convex_pixel_count + contour_pixel_count) / 2)) * 100
+    keep = diff <= max_diff
+
+    kept = [contours[i] for i in np.flatnonzero(keep)]
+    discarded = [contours[i] for i in np.flatnonzero(~keep)]
     return kept, discarded
 
 
-def draw_contour_lines(image: np.ndarray, contours: List[np.ndarray], type: Optional[str] = "multiple") -> np.ndarray:
+def draw_contour_lines(
+    image: np.ndarray,
+    contours: List[np.ndarray],
+    type: Optional[str] = "multiple",
+    hulls: Optional[List[np.ndarray]] = None) -> np.ndarray:
     """Draw the line of contours.
 
     Args:
         image (np.ndarray): The image to draw the contours on.
         contours (List[np.ndarray]): The list of the contours to be drawn.
         type (Optional[str]): The type of contours to draw. If `multiple`, draws the segmented contour, the convex hull contour and the overlaps between the segmented and convex contours. If `single`, draws only the segmented contour. Defaults to "multiple".
+        hulls (Optional[List[np.ndarray]], optional): The convex hulls of `contours`, if already computed. Only used when `type` is `multiple`. Defaults to None.
 
     Raises:
         ValueError: If `type` is not in [`multiple`, `single`].
@@ -310,12 +568,14 @@ def draw_contour_lines(image: np.ndarray, contours: List[np.ndarray], type: Opti
         np.ndarray: The image with the contours drawn on it.
     """
     if type == "multiple":
+        if hulls is None:
+            hulls = [cv2.convexHull(contour) for contour in contours]
+
         contour = np.zeros(image.shape, dtype=np.uint8)
         contour_convex = np.zeros(image.shape, dtype=np.uint8)
 
         cv2.drawContours(contour, contours=contours, contourIdx=-1, color=[1, 1, 1], thickness=1)
-        cv2.drawContours(
-            contour_convex, contours=[cv2.convexHull(discarded_contour) for discarded_contour in contours], contourIdx=-1, color=[1, 1, 1], thickness=1)
+        cv2.drawContours(contour_convex, contours=hulls, contourIdx=-1, color=[1, 1, 1], thickness=1)
 
         diff = contour + contour_convex
         diff[diff < 2] = 0
@@ -324,8 +584,7 @@ def draw_contour_lines(image: np.ndarray, contours: List[np.ndarray], type: Opti
         # Yellow = Smoothed contour
         cv2.drawContours(image, contours=contours, contourIdx=-1, color=[255, 255, 0], thickness=1)
         # Cyan = Convex hull of the smoothed contour
-        cv2.drawContours(
-            image, contours=[cv2.convexHull(discarded_contour) for discarded_contour in contours], contourIdx=-1, color=[0, 255, 255], thickness=1)
+        cv2.drawContours(image, contours=hulls, contourIdx=-1, color=[0, 255, 255], thickness=1)
 
         # White = Smoothed contour equals to Convex hull of the smoothed contour
         image = np.where(diff > 0, [255, 255, 255], image)
@@ -347,7 +606,7 @@ def analyze_contours(
         smooth (Optional[bool], optional): Whether or not to smooth the contours.
 
     Returns:
-        Tuple[Tuple[np.ndarray, np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray, np.ndarray]]: The first tuple contains the updated mask, and the nuclei and NORs contours. The second one contains the image with the discarded nuclei contours and AgNORs, and the discarded nuclei and NORs contours.
+        Tuple[Tuple[np.ndarray, np.ndarray, np.ndarray], Tuple[np.ndarray, np.ndarray, np.ndarray]]: The first tuple contains the updated mask, and the nuclei and NORs contours. The updated mask is a label image in the format `(HEIGHT, WIDTH)`, where `0` is background, `1` is nucleus and `2` is NOR, and can be expanded with `label_to_onehot`. The second one contains the image with the discarded nuclei contours and AgNORs, and the discarded nuclei and NORs contours.
     """
     # Obtain and filter nuclei and NORs contours
     nuclei_contours = get_contours(mask[:, :, 1] + mask[:, :, 2])
@@ -362,24 +621,20 @@ def analyze_contours(
         # nors_contours = smooth_contours(nors_contours, 16)
 
     nuclei_with_nors, nuclei_without_nors = discard_contours_without_contours(nuclei_contours, nors_contours)
-    nuclei_contours_adequate, nuclei_overlapping_deformed = discard_overlapping_deformed_contours(
-        nuclei_with_nors, shape=mask.shape[:2])
+    nuclei_with_nors = [ContourInfo(contour, shape=mask.shape[:2]) for contour in nuclei_with_nors]
+    nuclei_contours_adequate, nuclei_overlapping_deformed = discard_overlapping_deformed_contours(nuclei_with_nors)
+    nuclei_contours_adequate = [contour.points for contour in nuclei_contours_adequate]
+    # The convex hulls were already computed to find the deformed nuclei, keep them for drawing.
+    nuclei_overlapping_deformed_hulls = [contour.convex_hull for contour in nuclei_overlapping_deformed]
+    nuclei_overlapping_deformed = [contour.points for contour in nuclei_overlapping_deformed]
 
     nors_in_adequate_nuclei, _ = discard_contours_outside_contours(nuclei_contours_adequate, nors_contours)
     nors_in_overlapping_deformed, _ = discard_contours_outside_contours(nuclei_overlapping_deformed, nors_contours)
 
-    # Create a new mask with the filtered nuclei and NORs
-    pixel_intensity = int(np.max(np.unique(mask)))
-    background = np.ones(mask.shape[:2], dtype=np.uint8)
-    nucleus = np.zeros(mask.shape[:2], dtype=np.uint8)
-    nor = np.zeros(mask.shape[:2], dtype=np.uint8)
-
-    cv2.drawContours(nucleus, contours=nuclei_contours_adequate, contourIdx=-1, color=pixel_intensity, thickness=cv2.FILLED)
-    cv2.drawContours(nor, contours=nors_in_adequate_nuclei, contourIdx=-1, color=pixel_intensity, thickness=cv2.FILLED)
-
-    nucleus = np.where(nor, 0, nucleus)
-    background = np.where(np.logical_and(nucleus == 0, nor == 0), pixel_intensity, 0)
-    updated_mask = np.stack([background, nucleus, nor], axis=2).astype(np.uint8)
+    # Create a new label mask with the filtered nuclei and NORs. NORs are drawn last so they take precedence over nuclei.
+    updated_mask = np.zeros(mask.shape[:2], dtype=np.uint8)
+    cv2.drawContours(updated_mask, contours=nuclei_contours_adequate, contourIdx=-1, color=1, thickness=cv2.FILLED)
+    cv2.drawContours(updated_mask, contours=nors_in_adequate_nuclei, contourIdx=-1, color=2, thickness=cv2.FILLED)
 
     contour_detail = mask.copy()
     contour_detail = color_classes(contour_detail).copy()
@@ -394,7 +649,7 @@ def analyze_contours(
         contour_detail = draw_contour_lines(contour_detail, nors_size_discarded, type="single")
 
     if len(nuclei_overlapping_deformed) > 0:
-        contour_detail = draw_contour_lines(contour_detail, nuclei_overlapping_deformed)
+        contour_detail = draw_contour_lines(contour_detail, nuclei_overlapping_deformed, hulls=nuclei_overlapping_deformed_hulls)
     else:
         nuclei_overlapping_deformed, nors_in_overlapping_deformed = [], []
         if len(nuclei_size_discarded) == 0 and len(nuclei_without_nors) == 0:
@@ -418,7 +673,7 @@ def get_contour_measurements(
     exam_instance: Optional[str] = "",
     anatomical_site: Optional[str] = "",
     start_index: Optional[int] = 0,
-    contours_flag: Optional[str] = "valid") -> Union[List[dict], List[dict], int, int]:
+    contours_flag: Optional[str] = "valid") -> Union[List[tuple], List[dict], int, int]:
     """Calculate the number of pixels per contour and create a record for each of them.
     Args:
         parent_contours (List[np.ndarray]): The parent contours.
@@ -438,57 +693,66 @@ def get_contour_measurements(
         start_index (Optional[int], optional): The index to start the parent contour ID assignment. Usually it will not be `0` when discarded records are being measure for record purposes. Defaults to 0.
         contours_flag (Optional[str], optional): A string value identifying the characteristic of the record. Usually it will be `valid`, but it can be `discarded` or anything else. Defaults to "valid".
     Returns:
-        Union[List[dict], List[dict], int, int]: The parent and child contours, and the pixel count of the smallest and biggest AgNOR.
+        Union[List[tuple], List[dict], int, int]: The parent and child contours, and the pixel count of the smallest and biggest AgNOR. The parent records are tuples with the values in the order of `NUCLEUS_COLUMNS`.
     """
     parent_measurements = []
-    child_measurements = []
-
-    for parent_id, parent_contour in enumerate(parent_contours, start=start_index):
+    # Per-child values are gathered as columns, one array per parent.
+    child_columns = {
+        "nucleus": [],
+        "agnor": [],
+        "agnor_pixel_count": [],
+        "nucleus_ratio": [],
+        "greatest_agnor_ratio": [],
+        "smallest_agnor_ratio": []}
+
+    containment = get_contours_containment(parent_contours, child_contours)
+
+    for parent_id, (parent_contour, contained_children) in enumerate(zip(parent_contours, containment), start=start_index):
         parent_pixel_count = get_contour_pixel_count(parent_contour, shape)
         parent_features = [record_id, patient_name, mask_name, contours_flag, record_class, exam_date, exam_instance, anatomical_site, parent_id, parent_pixel_count, parent_type]
-        parent_measurements.append({ key: value for key, value in zip(NUCLEUS_COLUMNS, parent_features) })
-
-        contours_size = []
-
-        child_id = 0
-        for child_contour in child_contours:
-            for child_point in child_contour:
-                if cv2.pointPolygonTest(parent_contour, tuple(child_point[0]), False) >= 0:
-                    child_pixel_count = get_contour_pixel_count(child_contour, shape)
-                    contours_size.append(child_pixel_count)
-                    parent_pixel_count_ratio = child_pixel_count / parent_pixel_count
-                    child_features = [record_id, patient_name, mask_name, contours_flag, record_class, exam_date, exam_instance, anatomical_site, parent_id, child_id, child_pixel_count, child_type, parent_pixel_count_ratio]
-                    child_measurements.append({ key: value for key, value in zip(AGNOR_COLUMNS, child_features) })
-                    child_id += 1
-                    break
-
-    if len(contours_size) > 0:
-        min_contour_size = np.min(contours_size)
-        max_contour_size = np.max(contours_size)
-
-        for i, record in enumerate(child_measurements):
-            features = list(record.values())
-            features.append(record["agnor_pixel_count"] / max_contour_size)
-            features.append(record["agnor_pixel_count"] / min_contour_size)
-            child_measurements[i] = {key: value for key, value in zip(AGNOR_COLUMNS, features)}
+        parent_measurements.append(tuple(parent_features))
+
+        contours_size = np.array([
+            get_contour_pixel_count(child_contour, shape)
+            for child_contour, contained_child in zip(child_contours, contained_children) if contained_child], dtype=np.int64)
+        if len(contours_size) == 0:
+            continue
+
+        child_columns["nucleus"].append(np.full(len(contours_size), parent_id))
+        child_columns["agnor"].append(np.arange(len(contours_size)))
+        child_columns["agnor_pixel_count"].append(contours_size)
+        child_columns["nucleus_ratio"].append(contours_size / parent_pixel_count)
+        child_columns["greatest_agnor_ratio"].append(contours_size / contours_size.max())
+        child_columns["smallest_agnor_ratio"].append(contours_size / contours_size.min())
+
+    child_columns = {key: np.concatenate(values).tolist() if len(values) > 0 else [] for key, values in child_columns.items()}
+    child_metadata = [record_id, patient_name, mask_name, contours_flag, record_class, exam_date, exam_instance, anatomical_site]
+
+    child_measurements = []
+    for parent_id, child_id, child_pixel_count, parent_pixel_count_ratio, greatest_agnor_ratio, smallest_agnor_ratio in zip(*child_columns.values()):
+        child_features = child_metadata + [parent_id, child_id, child_pixel_count, child_type, parent_pixel_count_ratio, greatest_agnor_ratio, smallest_agnor_ratio]
+        child_measurements.append({ key: value for key, value in zip(AGNOR_COLUMNS, child_features) })
 
     return parent_measurements, child_measurements
 
 
 def write_contour_measurements(
-    parent_measurements: List[dict],
+    parent_measurements: List[tuple],
     child_measurements: List[dict],
     output_path: str,
     datetime: Optional[str] = time.strftime('%Y%m%d%H%M')) -> None:
     """Writes contour measurements to `.csv` files.
+
+    The measurements are buffered in memory and only written to disk by `flush_contour_measurements`, which `aggregate_measurements` calls before reading the files.
+
     Args:
-        parent_measurements (List[dict]): The parent contours.
+        parent_measurements (List[tuple]): The parent contours, with the values in the order of `NUCLEUS_COLUMNS`.
         child_measurements (List[dict]): The child contours.
         output_path (str): The path where the files should be written to.
         datetime (Optional[str], optional): A date and time identification for when the files were generated. Defaults to time.strftime('%Y%m%d%H%M%S').
     """
-    df_parent = pd.DataFrame(parent_measurements, columns=NUCLEUS_COLUMNS)
-    df_child = pd.DataFrame(child_measurements, columns=AGNOR_COLUMNS)
+    df_parent = pd.DataFrame.from_records(parent_measurements, columns=NUCLEUS_COLUMNS)
+    df_child = pd.DataFrame.from_records(child_measurements, columns=AGNOR_COLUMNS)
 
     df_child["nucleus"] = df_parent["nucleus"].unique()[0]
 
@@ -498,15 +762,22 @@ def write_contour_measurements(
     parent_measurements_output = Path(output_path).joinpath(f"nucleus_measurements_{datetime}.csv")
     child_measurements_output = Path(output_path).joinpath(f"agnor_measurements_{datetime}.csv")
 
-    if Path(parent_measurements_output).is_file():
-        df_parent.to_csv(str(parent_measurements_output), mode="a", header=False, index=False)
-    else:
-        df_parent.to_csv(str(parent_measurements_output), mode="w", header=True, index=False)
+    _MEASUREMENT_BUFFERS.setdefault(parent_measurements_output, []).append(df_parent)
+    _MEASUREMENT_BUFFERS.setdefault(child_measurements_output, []).append(df_child)
 
-    if Path(child_measurements_output).is_file():
-        df_child.to_csv(str(child_measurements_output), mode="a", header=False, index=False)
-    else:
-        df_child.to_csv(str(child_measurements_output), mode="w", header=True, index=False)
+
+def flush_contour_measurements() -> None:
+    """Writes the measurements buffered by `write_contour_measurements` to their `.csv` files.
+
+    Each file is written with a single call, appending to it if it already exists.
+    """
+    for output_path, measurements in _MEASUREMENT_BUFFERS.items():
+        df = pd.concat(measurements, ignore_index=True)
+        if output_path.is_file():
+            df.to_csv(str(output_path), mode="a", header=False, index=False)
+        else:
+            df.to_csv(str(output_path), mode="w", header=True, index=False)
+    _MEASUREMENT_BUFFERS.clear()
 
 
 def aggregate_measurements(
@@ -521,67 +792,50 @@ def aggregate_measurements(
         nucleus_measurements (str): Path to the .csv file containing the nuclei measurements.
         agnor_measurements (str): Path to the .csv file containing the AgNORs measurements.
         remove_measurement_files (Optional[bool], optional): Whether or not to remove the measurement files used for aggregation. Defaults to False.
-        database (Optional[str], optional): What file to save records to. Defaults to None.
+        database (Optional[str], optional): What file to save records to. The records are buffered until `flush_database` is called. Defaults to None.
         datetime (Optional[str], optional): A date and time identification for when the file was generated. Defaults to time.strftime('%Y%m%d%H%M%S').
     Returns:
         bool: `True` if function succeed otherwise `False`.
     """
+    flush_contour_measurements()
+
     # Patient,NNA1,NNA2,NNA3,NNA4,NNA5+,NNA1%,NNA2%,NNA3%,NNA4%,NNA5+%,Number of Nucleus, Number of AgNORs,Number of Clusters,Number of Satellites,Mean Nucleus Size (Pixels),Mean AgNOR Size (Pixels),Mean Cluster Size (Pixels),Mean Satellite (Pixels)
     if Path(nucleus_measurements).is_file():
-        df_nucleus = pd.read_csv(nucleus_measurements)
+        df_nucleus = pd.read_csv(nucleus_measurements, usecols=NUCLEUS_USE_COLS)
     else:
         logging.debug(f"Base measurement file '{nucleus_measurements}' not found")
         return False
     if Path(agnor_measurements).is_file():
-        df_agnor = pd.read_csv(agnor_measurements)
+        df_agnor = pd.read_csv(agnor_measurements, usecols=AGNOR_USE_COLS, dtype={"type": "category"})
     else:
         logging.debug(f"Base measurement file '{nucleus_measurements}' not found")
         return False
 
     number_of_nucleus = len(df_nucleus)
     number_of_agnors = len(df_agnor)
-    number_of_clusters = len(df_agnor[df_agnor["type"] == "cluster"])
-    number_of_satellites = len(df_agnor[df_agnor["type"] == "satellite"])
+    is_cluster = df_agnor["type"] == "cluster"
+    is_satellite = df_agnor["type"] == "satellite"
+    number_of_clusters = int(is_cluster.sum())
+    number_of_satellites = int(is_satellite.sum())
 
-    agnor_central_measurements = df_agnor[df_agnor["type"].str.contains("cluster|satellite")].groupby(["source_image", "nucleus"])["agnor"].count().reset_index()
+    agnor_central_measurements = df_agnor[df_agnor["type"].isin(("cluster", "satellite"))].groupby(["source_image", "nucleus"])["agnor"].count().reset_index()
     mean_agnor_per_nucleus = round(agnor_central_measurements["agnor"].mean(), 2)
     median_agnor_per_nucleus = round(agnor_central_measurements["agnor"].median(), 2)
 
     mean_nucleus_size = round(df_nucleus["nucleus_pixel_count"].mean(), 2)
     mean_agnor_size = round(df_agnor["agnor_pixel_count"].mean(), 2)
-    mean_cluster_size = round(df_agnor[df_agnor["type"] == "cluster"]["agnor_pixel_count"].mean(), 2)
-    mean_satellite_size = round(df_agnor[df_agnor["type"] == "satellite"]["agnor_pixel_count"].mean(), 2)
+    mean_cluster_size = round(df_agnor.loc[is_cluster, "agnor_pixel_count"].mean(), 2)
+    mean_satellite_size = round(df_agnor.loc[is_satellite, "agnor_pixel_count"].mean(), 2)
 
-    n_nuclei_with_n_agnors = df_agnor.groupby(["source_image", "nucleus"])["agnor"].count().reset_index()
-    n_nuclei_with_n_agnors = n_nuclei_with_n_agnors.groupby(["agnor"]).size().reset_index(name="count")
-
-    if len(n_nuclei_with_n_agnors[n_nuclei_with_n_agnors["agnor"] == 1]["count"]) > 0:
-        nna1 = n_nuclei_with_n_agnors[n_nuclei_with_n_agnors["agnor"] == 1]["count"].iloc[0]
-    else:
-        nna1 = 0
-    if len(n_nuclei_with_n_agnors[n_nuclei_with_n_agnors["agnor"] == 2]["count"]) > 0:
-        nna2 = n_nuclei_with_n_agnors[n_nuclei_with_n_agnors["agnor"] == 2]["count"].iloc[0]
-    else:
-        nna2 = 0
-    if len(n_nuclei_with_n_agnors[n_nuclei_with_n_agnors["agnor"] == 3]["count"]) > 0:
-        nna3 = n_nuclei_with_n_agnors[n_nuclei_with_n_agnors["agnor"] == 3]["count"].iloc[0]
-    else:
-        nna3 = 0
-    if len(n_nuclei_with_n_agnors[n_nuclei_with_n_agnors["agnor"] == 4]["count"]) > 0:
-        nna4 = n_nuclei_with_n_agnors[n_nuclei_with_n_agnors["agnor"] == 4]["count"].iloc[0]
-    else:
-        nna4 = 0
-    if len(n_nuclei_with_n_agnors[n_nuclei_with_n_agnors["agnor"] >= 5]["count"]) > 0:
-        nna5_plus = n_nuclei_with_n_agnors[n_nuclei_with_n_agnors["agnor"] >= 5]["count"].sum()
-    else:
-        nna5_plus = 0
+    # Number of nuclei with 1, 2, 3, 4, and 5 or more AgNORs.
+    agnors_per_nucleus = df_agnor.groupby(["source_image", "nucleus"])["agnor"].count().to_numpy()
+    n_nuclei_with_n_agnors = np.bincount(agnors_per_nucleus, minlength=6)
+    nna1, nna2, nna3, nna4 = n_nuclei_with_n_agnors[1:5]
+    nna5_plus = n_nuclei_with_n_agnors[5:].sum()
 
     if number_of_nucleus > 0:
-        nna1_percent = round(nna1 / number_of_nucleus, 2)
-        nna2_percent = round(nna2 / number_of_nucleus, 2)
-        nna3_percent = round(nna3 / number_of_nucleus, 2)
-        nna4_percent = round(nna4 / number_of_nucleus, 2)
-        nna5_plus_percent = round(nna5_plus / number_of_nucleus, 2)
+        nna1_percent, nna2_percent, nna3_percent, nna4_percent, nna5_plus_percent = \
+            np.round(np.array([nna1, nna2, nna3, nna4, nna5_plus]) / number_of_nucleus, 2).tolist()
     else:
         nna1_percent = 0
         nna2_percent = 0
@@ -637,40 +891,62 @@ def aggregate_measurements(
     if database is not None and database != "":
         if not database.endswith(".csv"):
             database = f"{database}.csv"
+        _DATABASE_BUFFERS.setdefault(database, []).append(df)
+
+    return True
+
+
+@atexit.register
+def flush_database() -> None:
+    """Writes the aggregate measurements buffered by `aggregate_measurements` to their database files.
+
+    Each database is written with a single call, appending to it if it already exists. Also runs when the program exits.
+    """
+    for database, records in _DATABASE_BUFFERS.items():
+        df = pd.concat(records, ignore_index=True)
         if Path(database).is_file():
             df.to_csv(database, mode="a", header=False, index=False, sep=";", decimal=",", quoting=csv.QUOTE_NONNUMERIC)
         else:
             df.to_csv(database, mode="w", header=True, index=False, sep=";", decimal=",", quoting=csv.QUOTE_NONNUMERIC)
+    _DATABASE_BUFFERS.clear()
 
-    return True
 
+@functools.lru_cache(maxsize=4)
+def load_classifier(model_path: str, modified_time: float):
+    """Loads a Scikit-Learn model, reusing it between calls.
 
-def classify_agnor(model_path: str, contours: List[np.ndarray]) -> List[np.ndarray]:
+    Args:
+        model_path (str): Path to the model file.
+        modified_time (float): The modification time of the model file. Part of the cache key, so the model is loaded again if the file changes.
+
+    Returns:
+        The loaded model.
+    """
+    return joblib.load(model_path)
+
+
+def classify_agnor(model_path: str, contours: List[dict]) -> List[dict]:
     """Loads a Scikit-Learn model and classify the input arrays in `clusters` and `satellites`.
     Args:
         model_path (str): Path to the model file.
-        contours (List[np.ndarray]): Input array containing the features `agnor_pixel_count`, `nucleus_ratio`, `smallest_agnor_ratio`, `greatest_agnor_ratio`."
+        contours (List[dict]): AgNOR records, as returned by `get_contour_measurements`, containing the features in `AGNOR_FEATURES`.
     Returns:
-        List[np.ndarray]: Updated array with a column containing the predicted class of each element in the input array, where `0` corresponds to `cluster` and `1` to `satellite`.
+        List[dict]: The input records, with the `type` of each record updated in place to its predicted class.
     """
     if len(contours) == 0:
         return contours
 
-    features_list = [
-        "agnor_pixel_count",
-        "nucleus_ratio",
-        "smallest_agnor_ratio",
-        "greatest_agnor_ratio"
-    ]
+    # Scikit-Learn trees work in `float32`, so the features are gathered in that type to avoid a conversion.
+    features = np.fromiter(
+        (contour[feature] for contour in contours for feature in AGNOR_FEATURES),
+        dtype=np.float32,
+        count=len(contours) * len(AGNOR_FEATURES)).reshape(-1, len(AGNOR_FEATURES))
 
-    df = pd.DataFrame.from_dict(contours)
-    features = df[features_list].copy()
-
-    classifier = joblib.load(model_path)
+    classifier = load_classifier(str(model_path), Path(model_path).stat().st_mtime)
     predictions = classifier.predict(features)
-    df["type"] = predictions
 
-    contours = list(df.T.to_dict().values())
+    for contour, prediction in zip(contours, predictions.tolist()):
+        contour["type"] = prediction
     return contours
 
 
@@ -694,23 +970,21 @@ def discard_unboxed_contours(
         bboxes = get_labelme_points(annotation, shape_types=["rectangle"])
 
         # Convert bboxes into contours with four points.
-        for i in range(len(bboxes)):
-            bboxes[i] = convert_bbox_to_contour(bboxes[i].tolist())
-
-        parent_contours, _ = discard_contours_outside_contours(bboxes, parent_contours)
+        bboxes = list(convert_bboxes_to_contours(bboxes))
+
+        # Rasterize the bounding boxes and keep the nuclei with a point inside them.
+        # Each box is drawn on its own, as filling them in a single call would leave the overlaps between boxes empty.
+        boxes = np.zeros(prediction.shape[:2], dtype=np.uint8)
+        for bbox in bboxes:
+            cv2.drawContours(boxes, contours=[bbox], contourIdx=-1, color=1, thickness=cv2.FILLED)
+        parent_contours, _ = discard_contours_outside_mask(boxes, parent_contours)
         child_contours, _ = discard_contours_outside_contours(parent_contours, child_contours)
 
-        # Create a new mask with the filtered nuclei and NORs
-        pixel_intensity = int(np.max(np.unique(prediction)))
-        background = np.ones(prediction.shape[:2], dtype=np.uint8)
-        nucleus = np.zeros(prediction.shape[:2], dtype=np.uint8)
-        nor = np.zeros(prediction.shape[:2], dtype=np.uint8)
-
-        cv2.drawContours(nucleus, contours=parent_contours, contourIdx=-1, color=pixel_intensity, thickness=cv2.FILLED)
-        cv2.drawContours(nor, contours=child_contours, contourIdx=-1, color=pixel_intensity, thickness=cv2.FILLED)
-
-        nucleus = np.where(nor, 0, nucleus)
-        background = np.where(np.logical_and(nucleus == 0, nor == 0), pixel_intensity, 0)
-        prediction = np.stack([background, nucleus, nor], axis=2).astype(np.uint8)
+        # Create a new mask with the filtered nuclei and NORs. NORs are drawn last so they take precedence over nuclei.
+        pixel_intensity = int(np.max(prediction))
+        label = np.zeros(prediction.shape[:2], dtype=np.uint8)
+        cv2.drawContours(label, contours=parent_contours, contourIdx=-1, color=1, thickness=cv2.FILLED)
+        cv2.drawContours(label, contours=child_contours, contourIdx=-1, color=2, thickness=cv2.FILLED)
+        prediction = label_to_onehot(label, pixel_intensity=pixel_intensity)
 
     return prediction, parent_contours, child_contours
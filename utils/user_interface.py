@@ -15,6 +15,11 @@ SECONDARY_FONT = ("Arial", "10")
 TERTIARY_FONT = ("Arial", "8", "italic")
 CONFIG_FILE = "config.txt"
 
+# Checked once when the module is loaded. `None` if the icon file is missing.
+ICON_PATH = Path(ROOT_PATH).joinpath("icon.ico")
+if not ICON_PATH.is_file():
+    ICON_PATH = None
+
 TOOLTIPS = {
     "patient": "Unique patient identifier. It can be the patient name or an ID/code.",
     "patient_record": "The record number of the patient.",
@@ -201,11 +206,10 @@ def get_window() -> sg.Window:
     sg.theme("DarkBlue")
     layout = get_layout()
     logging.debug(f"""Create window""")
-    icon_path = Path(ROOT_PATH).joinpath("icon.ico")
     try:
-        if Path(icon_path).is_file():
+        if ICON_PATH is not None:
             logging.debug(f"""Load icon""")
-            window = sg.Window(PROGRAM_NAME, layout, finalize=True, icon=icon_path)
+            window = sg.Window(PROGRAM_NAME, layout, finalize=True, icon=ICON_PATH)
         else:
             window = sg.Window(PROGRAM_NAME, layout, finalize=True)
     except Exception as e:
@@ -43,6 +43,21 @@ def collapse_probabilities(
     return prediction.astype(np.uint8)
 
 
+def label_to_onehot(label: np.ndarray, classes: Optional[int] = 3, pixel_intensity: Optional[int] = 127) -> np.ndarray:
+    """Expands a label image into the one-hot-encoded format returned by `collapse_probabilities`.
+
+    Args:
+        label (np.ndarray): A label image in the format `(HEIGHT, WIDTH)`, where each pixel holds the index of its class.
+        classes (Optional[int], optional): The number of channels of the output. Channels of classes not present in `label` are left empty. Defaults to 3.
+        pixel_intensity (Optional[int], optional): The intensity each pixel class will be assigned. Defaults to 127.
+
+    Returns:
+        np.ndarray: The one-hot-encoded image in the format `(HEIGHT, WIDTH, CLASSES)`.
+    """
+    # Each channel is computed in a single pass, multiplying the boolean mask straight into `uint8`.
+    return cv2.merge([np.multiply(label == i, np.uint8(pixel_intensity), dtype=np.uint8) for i in range(classes)])
+
+
 def color_classes(prediction: np.ndarray) -> np.ndarray:
     """Color a n-dimensional array of one-hot-encoded semantic segmentation image.
 
@@ -72,10 +87,10 @@ def color_classes(prediction: np.ndarray) -> np.ndarray:
     for i in range(n_classes):
         class_maps.append(prediction[:, :, i] > 0)
 
-    # Recolor classes.
+    # Recolor classes in place, writing only the pixels of each class.
     for i in range(n_classes):
         for j in range(3): # 3 color channels
-            prediction[:, :, j] = np.where(class_maps[i], color_map[i][j], prediction[:, :, j])
+            np.copyto(prediction[:, :, j], color_map[i][j], where=class_maps[i])
 
     # Remove any extra channels so the array can be saved as an image.
     prediction = prediction[:, :, :3]
@@ -383,6 +398,24 @@ def convert_bbox_to_contour(bbox: np.ndarray) -> np.array:
     return bbox
 
 
+def convert_bboxes_to_contours(bboxes: np.ndarray) -> np.ndarray:
+    """Converts multiple `labelme` bounding boxes to contours at once.
+
+    Gives the same points as calling `convert_bbox_to_contour` on each bounding box.
+
+    Args:
+        bboxes (np.ndarray): The bounding boxes points, in the format `(N, 2, 2)`.
+
+    Returns:
+        np.ndarray: The contours in the format `(N, 4, 2)`.
+    """
+    bboxes = np.asarray(bboxes, dtype=np.int32).reshape(-1, 2, 2)
+    top_left, bottom_right = bboxes[:, 0], bboxes[:, 1]
+    top_right = np.stack([bottom_right[:, 0], top_left[:, 1]], axis=-1)
+    bottom_left = np.stack([top_left[:, 0], bottom_right[:, 1]], axis=-1)
+    return np.stack([top_left, top_right, bottom_right, bottom_left], axis=1)
+
+
 def get_object_classes(annotation_path):
     annotation_path = Path(annotation_path)
     if not annotation_path.is_file():